@@ -7,8 +7,6 @@ __metaclass__ = type
 
 import logging
 
-from google.auth.credentials import Credentials
-
 DOCUMENTATION = r'''
 lookup: aws_secret
 author:
@@ -60,6 +58,27 @@ options:
     default: error
     type: string
     choices: ['error', 'skip', 'warn']
+  pool_size:
+    description:
+        - Number of gRPC channels used to fetch secrets concurrently.
+        - All terms are requested at once and spread across the channels, which multiplex them as HTTP/2 streams.
+    type: integer
+    default: 3
+  cache_ttl:
+    description:
+        - Number of seconds a fetched secret is reused within the same process instead of being fetched again.
+        - Secrets pinned to a numeric I(version_id) are immutable and are cached for the lifetime of the process.
+        - C(0) disables caching.
+    type: float
+    default: 60
+  negative_cache_ttl:
+    description:
+        - Number of seconds a secret found missing or denied is remembered, so that I(on_missing) and I(on_denied)
+          are applied again without contacting Google Secrets Manager.
+        - Kept short so that creating the secret or granting access takes effect quickly.
+        - C(0) disables caching of failures.
+    type: float
+    default: 30
 '''
 
 EXAMPLES = r"""
@@ -84,27 +103,190 @@ _raw:
     Returns the value of the secret stored in Google Secrets Manager.
 """
 
+import asyncio
+import atexit
+import concurrent.futures
 import json
-
-try:
-    from google.cloud import secretmanager
-    from google.cloud.secretmanager_v1 import SecretManagerServiceClient
-    from google.api_core.exceptions import NotFound as NF
-    from google.api_core.exceptions import PermissionDenied as PD
-    from google.api_core.exceptions import ClientError as CE
-
-except ImportError as e:
-    raise e # will be captured by imported HAS_BOTO3
+import os
+import threading
+import time
+from functools import lru_cache
 
 from ansible.errors import AnsibleError
-from ansible.module_utils.six import string_types
 from ansible.module_utils._text import to_native
 from ansible.plugins.lookup import LookupBase
 
+# The Google Cloud SDK is slow to import, so it is only loaded by _ensure_imports() when
+# the lookup is actually used rather than whenever Ansible enumerates lookup plugins.
+secretmanager = None
+NF = PD = CE = None
+
+
+def _ensure_imports():
+    global secretmanager, NF, PD, CE
+    if secretmanager is not None:
+        return
+    # An ImportError propagates unchanged, as it did when these imports were at module level.
+    from google.cloud import secretmanager as _secretmanager
+    from google.api_core.exceptions import NotFound
+    from google.api_core.exceptions import PermissionDenied
+    from google.api_core.exceptions import ClientError
+    NF, PD, CE = NotFound, PermissionDenied, ClientError
+    secretmanager = _secretmanager
+
+
+_VALID_ACTIONS = frozenset(('error', 'warn', 'skip'))
+
+# (error, warning) messages for each kind of access failure honoured by on_missing/on_denied.
+_FAILURE_MESSAGES = {
+    'missing': ("Failed to find secret %s (ResourceNotFound)", 'Skipping, did not find secret %s'),
+    'denied': ("Failed to access secret %s (AccessDenied)", 'Skipping, access denied for secret %s'),
+}
+
+
+def _failure_kind(exc):
+    return 'missing' if isinstance(exc, NF) else 'denied'
+
+
+# Sentinel for keys absent from a nested secret, distinct from a stored null.
+_MISSING = object()
+
+# Clients are cached per (project_id, credential_file, slot) so that repeated lookups
+# reuse the same gRPC channel instead of re-establishing TLS and auth each time.
+_CLIENT_CACHE = {}
+_CLIENT_LOCK = threading.Lock()
+
+# Async gRPC channels are bound to the event loop they were created on, so every lookup
+# runs on one long-lived loop in a background thread rather than a fresh asyncio.run().
+_LOOP = None
+
+# Upper bound in seconds for a whole lookup, so a stuck loop fails the task instead of hanging it.
+_LOOKUP_TIMEOUT = 300
+
+
+def _get_loop():
+    global _LOOP
+    with _CLIENT_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name='gsm-lookup', daemon=True).start()
+    return _LOOP
+
+
+def _get_client(project_id, credential_file=None, slot=0):
+    # Must be called from the loop returned by _get_loop().
+    key = (project_id, credential_file, slot)
+    with _CLIENT_LOCK:
+        client = _CLIENT_CACHE.get(key)
+        if client is None:
+            if credential_file:
+                client = secretmanager.SecretManagerServiceAsyncClient.from_service_account_file(credential_file)
+            else:
+                client = secretmanager.SecretManagerServiceAsyncClient()
+            _CLIENT_CACHE[key] = client
+    return client
+
+
+def _reset_after_fork():
+    # gRPC channels are unusable after a fork, so forked Ansible workers build their own clients.
+    # The parent's clients are dropped rather than closed, as closing would affect the parent.
+    # The inherited loop still reports is_running() but its thread did not survive the fork.
+    # Locks are recreated as the fork may have happened while a loop task was holding one.
+    global _CLIENT_LOCK, _SECRET_LOCK, _LOOP
+    _CLIENT_LOCK = threading.Lock()
+    _SECRET_LOCK = threading.Lock()
+    _CLIENT_CACHE.clear()
+    _LOOP = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Raw payload bytes are cached per (credential_file, fully-qualified version name) as
+# (expires_at, payload); the credential is part of the key so that a secret fetched with
+# one identity is never served to another that may not be allowed to read it.
+_SECRET_CACHE = {}
+# Failed accesses are cached under the same (credential_file, name) key as (expires_at,
+# 'missing' or 'denied'), so repeated probes of an absent secret are answered without an
+# RPC or an exception while other credentials still get their own answer.
+_NEGATIVE_CACHE = {}
+_SECRET_LOCK = threading.Lock()
+
+
+def _cached_failure(credential_file, name):
+    with _SECRET_LOCK:
+        entry = _NEGATIVE_CACHE.get((credential_file, name))
+    if entry is not None and time.monotonic() < entry[0]:
+        return entry[1]
+    return None
+
+
+async def _access_secret_version(client, name, cache_ttl, negative_cache_ttl=0, credential_file=None):
+    key = (credential_file, name)
+    now = time.monotonic()
+    if cache_ttl > 0:
+        with _SECRET_LOCK:
+            entry = _SECRET_CACHE.get(key)
+        if entry is not None and now < entry[0]:
+            return entry[1]
+
+    request = secretmanager.AccessSecretVersionRequest(name=name)
+    try:
+        payload = (await client.access_secret_version(request=request)).payload.data
+    except (NF, PD) as exc:
+        if negative_cache_ttl > 0:
+            with _SECRET_LOCK:
+                _NEGATIVE_CACHE[key] = (now + negative_cache_ttl, _failure_kind(exc))
+        raise
+
+    if cache_ttl <= 0:
+        return payload
+
+    # Numbered versions can never change, only "latest" and aliases move.
+    if name.rsplit('/', 1)[-1].isdigit():
+        expires_at = float('inf')
+    else:
+        expires_at = now + cache_ttl
+    with _SECRET_LOCK:
+        _SECRET_CACHE[key] = (expires_at, payload)
+    return payload
+
+
+@lru_cache(maxsize=1024)
+def _parse_nested_term(term):
+    """Split a nested query into its secret name and a tuple of keys, once per distinct term."""
+    parts = term.split('.')
+    if len(parts) < 2:
+        raise AnsibleError("Nested query must use the following syntax: `aws_secret_name.<key_name>.<key_name>")
+    return parts[0], tuple(parts[1:])
+
+
+async def _close_clients():
+    with _CLIENT_LOCK:
+        clients = list(_CLIENT_CACHE.values())
+        _CLIENT_CACHE.clear()
+    for client in clients:
+        try:
+            await client.transport.grpc_channel.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+@atexit.register
+def _shutdown_loop():
+    if _LOOP is None or not _LOOP.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_clients(), _LOOP).result(timeout=5)
+    except Exception:  # pylint: disable=broad-except
+        pass
+    _LOOP.call_soon_threadsafe(_LOOP.stop)
+
 
 class LookupModule(LookupBase):
     def run(self, terms, project_id, credential_file=None, variables=None, nested=False, join=False, version_id="latest", on_missing='error',
-            on_denied='error'):
+            on_denied='error', pool_size=3, cache_ttl=60, negative_cache_ttl=30):
         '''
                    :arg project_id: The project in which the secrets reside
                    terms: a list of lookups to run.
@@ -116,77 +298,157 @@ class LookupModule(LookupBase):
                    :kwarg version_id: Version of the secret(s)
                    :kwarg on_missing: Action to take if the secret is missing
                    :kwarg on_denied: Action to take if access to the secret is denied
+                   :kwarg pool_size: Number of gRPC channels used to fetch secrets concurrently
+                   :kwarg cache_ttl: Seconds a fetched secret is reused before fetching it again, 0 to disable
+                   :kwarg negative_cache_ttl: Seconds a missing or denied secret is remembered, 0 to disable
                    :returns: A list of parameter values or a list of dictionaries if bypath=True.
                '''
+        _ensure_imports()
+
         missing = on_missing.lower()
-        if not isinstance(missing, string_types) or missing not in ['error', 'warn', 'skip']:
+        if missing not in _VALID_ACTIONS:
             raise AnsibleError('"on_missing" must be a string and one of "error", "warn" or "skip", not %s' % missing)
 
         denied = on_denied.lower()
-        if not isinstance(denied, string_types) or denied not in ['error', 'warn', 'skip']:
+        if denied not in _VALID_ACTIONS:
             raise AnsibleError('"on_denied" must be a string and one of "error", "warn" or "skip", not %s' % denied)
 
-        if credential_file:
-            client = secretmanager.SecretManagerServiceClient.from_service_account_file(credential_file)
-        else:
-            client = secretmanager.SecretManagerServiceClient()
-
-        secrets = []
-        for term in terms:
-            value = self.get_secret_value(term, client, project_id, version_id=version_id,
-                                          on_missing=missing, on_denied=denied, nested=nested)
-            if value:
-                secrets.append(value)
-        if join:
-            joined_secret = []
-            joined_secret.append(''.join(secrets))
-            return joined_secret
+        try:
+            pool_size = int(pool_size)
+        except (TypeError, ValueError):
+            raise AnsibleError('"pool_size" must be a positive integer, not %s' % pool_size)
+        if pool_size < 1:
+            raise AnsibleError('"pool_size" must be a positive integer, not %s' % pool_size)
 
-        return secrets
+        try:
+            cache_ttl = float(cache_ttl)
+        except (TypeError, ValueError):
+            raise AnsibleError('"cache_ttl" must be a number of seconds, not %s' % cache_ttl)
 
-    def get_secret_value(self, term, client: SecretManagerServiceClient, project_id, version_id,
-                         on_missing=None, on_denied=None, nested=False):
-        parent = f"projects/{project_id}/secrets"
-        name = f"{parent}/{term}/versions"
+        try:
+            negative_cache_ttl = float(negative_cache_ttl)
+        except (TypeError, ValueError):
+            raise AnsibleError('"negative_cache_ttl" must be a number of seconds, not %s' % negative_cache_ttl)
+
+        # Repeated terms are fetched once and mapped back onto their positions afterwards.
+        unique_terms = list(dict.fromkeys(terms))
         if nested:
-            if len(term.split('.')) < 2:
-                raise AnsibleError("Nested query must use the following syntax: `aws_secret_name.<key_name>.<key_name>")
-            secret_name = term.split('.')[0]
-            name = f"{parent}/{secret_name}/versions"
-        if version_id:
-            name = f"{name}/{version_id}"
+            # Nested queries against the same secret share a single fetch and parse.
+            groups = {}
+            for term in unique_terms:
+                groups.setdefault(_parse_nested_term(term)[0], []).append(term)
+            batches = list(groups.values())
         else:
-            name = f"{name}/latest"
+            batches = [[term] for term in unique_terms]
 
-        try:
-            response = client.access_secret_version(request={"name": name})
-            payload = response.payload.data.decode("UTF-8")
+        parent = "projects/%s/secrets" % project_id
 
+        async def fetch(client, batch):
             if nested:
-                query = term.split('.')[1:]
-                secret_string = json.loads(payload)
-                ret_val = secret_string
-                for key in query:
-                    if key in ret_val:
-                        ret_val = ret_val[key]
-                    else:
-                        raise AnsibleError(
-                            "Successfully retrieved secret but there exists no key {0} in the secret".format(key))
-                return str(ret_val)
-            else:
-                return payload
-        except NF:
-            if on_missing == 'error':
-                raise AnsibleError("Failed to find secret %s (ResourceNotFound)" % term)
-            elif on_missing == 'warn':
-                self._display.warning('Skipping, did not find secret %s' % term)
-        except PD:  # pylint: disable=duplicate-except
-            if on_denied == 'error':
-                raise AnsibleError("Failed to access secret %s (AccessDenied)" % term)
-            elif on_denied == 'warn':
-                self._display.warning('Skipping, access denied for secret %s' % term)
+                return await self.get_nested_secret_values(batch, client, parent, version_id=version_id,
+                                                           on_missing=missing, on_denied=denied, cache_ttl=cache_ttl,
+                                                           negative_cache_ttl=negative_cache_ttl,
+                                                           credential_file=credential_file)
+            return [await self.get_secret_value(batch[0], client, parent, version_id=version_id,
+                                                on_missing=missing, on_denied=denied, cache_ttl=cache_ttl,
+                                                negative_cache_ttl=negative_cache_ttl,
+                                                credential_file=credential_file)]
+
+        async def fetch_all():
+            clients = [_get_client(project_id, credential_file, slot) for slot in range(min(pool_size, len(batches) or 1))]
+            tasks = [asyncio.ensure_future(fetch(clients[index % len(clients)], batch))
+                     for index, batch in enumerate(batches)]
+            try:
+                return await asyncio.gather(*tasks)
+            finally:
+                # Once one term fails (or the lookup times out) the rest must not keep issuing
+                # RPCs, filling the caches or warning on behalf of a task that has already failed.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        future = asyncio.run_coroutine_threadsafe(fetch_all(), _get_loop())
+        try:
+            batch_values = future.result(timeout=_LOOKUP_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise AnsibleError("Timed out after %s seconds retrieving secrets" % _LOOKUP_TIMEOUT)
+
+        results = {}
+        for batch, values in zip(batches, batch_values):
+            results.update(zip(batch, values))
+        if join:
+            return [''.join(results[term] or '' for term in terms)]
+
+        return [results[term] for term in terms if results[term]]
+
+    async def get_secret_value(self, term, client: 'secretmanager.SecretManagerServiceAsyncClient', parent, version_id,
+                               on_missing=None, on_denied=None, nested=False, cache_ttl=0, negative_cache_ttl=0,
+                               credential_file=None):
+        if nested:
+            return (await self.get_nested_secret_values([term], client, parent, version_id, on_missing=on_missing,
+                                                        on_denied=on_denied, cache_ttl=cache_ttl,
+                                                        negative_cache_ttl=negative_cache_ttl,
+                                                        credential_file=credential_file))[0]
+
+        payload = await self._get_payload(term, client, parent, version_id, on_missing=on_missing,
+                                          on_denied=on_denied, cache_ttl=cache_ttl,
+                                          negative_cache_ttl=negative_cache_ttl, credential_file=credential_file)
+        return None if payload is None else payload.decode("UTF-8")
+
+    async def _get_payload(self, term, client, parent, version_id, on_missing=None, on_denied=None, cache_ttl=0,
+                           negative_cache_ttl=0, credential_file=None):
+        name = "%s/%s/versions/%s" % (parent, term, version_id or "latest")
+
+        if negative_cache_ttl > 0:
+            failure = _cached_failure(credential_file, name)
+            if failure is not None:
+                return self._handle_failure(failure, term, on_missing, on_denied)
+
+        try:
+            return await _access_secret_version(client, name, cache_ttl, negative_cache_ttl, credential_file)
+        except (NF, PD) as exc:
+            return self._handle_failure(_failure_kind(exc), term, on_missing, on_denied)
         except (
                 CE) as exc:  # pylint: disable=duplicate-except
             raise AnsibleError("Failed to retrieve secret: %s" % to_native(exc))
 
+    def _handle_failure(self, failure, term, on_missing, on_denied):
+        error_msg, warning_msg = _FAILURE_MESSAGES[failure]
+        action = on_missing if failure == 'missing' else on_denied
+        if action == 'error':
+            raise AnsibleError(error_msg % term)
+        elif action == 'warn':
+            self._display.warning(warning_msg % term)
         return None
+
+    async def get_nested_secret_values(self, terms, client: 'secretmanager.SecretManagerServiceAsyncClient', parent, version_id,
+                                       on_missing=None, on_denied=None, cache_ttl=0, negative_cache_ttl=0,
+                                       credential_file=None):
+        '''
+                   Resolve nested queries that all address the same secret, fetching and parsing it only once.
+                   :arg terms: nested queries sharing the same secret name, e.g. ['secret.key1', 'secret.key2.key3']
+                   :returns: A list of values in the order of terms, or Nones if the secret was skipped.
+               '''
+        queries = [_parse_nested_term(term) for term in terms]
+        secret_name = queries[0][0]
+
+        # json parses the payload bytes directly, so it is never decoded to str first.
+        payload = await self._get_payload(secret_name, client, parent, version_id, on_missing=on_missing,
+                                          on_denied=on_denied, cache_ttl=cache_ttl,
+                                          negative_cache_ttl=negative_cache_ttl, credential_file=credential_file)
+        if payload is None:
+            return [None] * len(terms)
+
+        secret_string = json.loads(payload)
+        get = dict.get
+        values = []
+        for _, query in queries:
+            ret_val = secret_string
+            for key in query:
+                ret_val = get(ret_val, key, _MISSING) if isinstance(ret_val, dict) else _MISSING
+                if ret_val is _MISSING:
+                    raise AnsibleError(
+                        "Successfully retrieved secret but there exists no key {0} in the secret".format(key))
+            values.append(str(ret_val))
+        return values